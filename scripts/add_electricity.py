@@ -54,7 +54,7 @@ Inputs
 
 - ``data/geth2015_hydro_capacities.csv``: alternative to capacities above; not currently used!
 - ``resources/load.csv`` Hourly per-country load profiles.
-- ``resources/regions_onshore.geojson``: confer :ref:`busregions`
+- ``resources/regions_onshore.gpkg``: confer :ref:`busregions`
 - ``resources/nuts3_shapes.geojson``: confer :ref:`shapes`
 - ``resources/powerplants.csv``: confer :ref:`powerplants`
 - ``resources/profile_{}.nc``: all technologies in ``config["renewables"].keys()``, confer :ref:`renewableprofiles`.
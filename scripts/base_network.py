@@ -57,6 +57,8 @@ Outputs
     .. image:: ../img/base.png
         :scale: 33 %
 
+- ``resources/buses_base.csv``: bus locations, countries and substation flags of ``networks/base.nc``
+
 Description
 -----------
 
@@ -79,6 +81,11 @@ from itertools import product
 from shapely.geometry import Point, LineString
 import shapely, shapely.prepared, shapely.wkt
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 logger = logging.getLogger(__name__)
 
 
@@ -267,7 +274,7 @@ def _load_lines_from_eg(buses, eg_lines):
 
 def _apply_parameter_corrections(n, parameter_corrections):
     with open(parameter_corrections) as f:
-        corrections = yaml.safe_load(f)
+        corrections = yaml.load(f, Loader=SafeLoader)
 
     if corrections is None: return
 
@@ -597,4 +604,8 @@ if __name__ == "__main__":
                      snakemake.input.parameter_corrections, snakemake.config)
 
     n.meta = snakemake.config
-    n.export_to_netcdf(snakemake.output[0])
+    n.export_to_netcdf(snakemake.output.network)
+
+    # light-weight copy of the bus attributes needed by build_bus_regions
+    bus_cols = ['country', 'substation_lv', 'substation_off', 'x', 'y']
+    n.buses[bus_cols].to_csv(snakemake.output.buses, index_label='name')
@@ -12,6 +12,10 @@ Relevant Settings
 
     countries:
 
+    bus_regions:
+        method:
+        raster_resolution:
+
 .. seealso::
     Documentation of the configuration file ``config.yaml`` at
     :ref:`toplevel_cf`
@@ -21,17 +25,17 @@ Inputs
 
 - ``resources/country_shapes.geojson``: confer :ref:`shapes`
 - ``resources/offshore_shapes.geojson``: confer :ref:`shapes`
-- ``networks/base.nc``: confer :ref:`base`
+- ``resources/buses_base.csv``: bus locations and substation flags of ``networks/base.nc``, confer :ref:`base`
 
 Outputs
 -------
 
-- ``resources/regions_onshore.geojson``:
+- ``resources/regions_onshore.gpkg``:
 
     .. image:: ../img/regions_onshore.png
         :scale: 33 %
 
-- ``resources/regions_offshore.geojson``:
+- ``resources/regions_offshore.gpkg``:
 
     .. image:: ../img/regions_offshore.png
         :scale: 33 %
@@ -44,17 +48,50 @@ Description
 import logging
 from _helpers import configure_logging, REGION_COLS
 
-import pypsa
 import os
+import multiprocessing as mp
 import pandas as pd
 import numpy as np
 import geopandas as gpd
-from shapely.geometry import Polygon
-from scipy.spatial import Voronoi
+import rasterio as rio
+from rasterio.features import geometry_mask, shapes
+from functools import partial
+from shapely.geometry import Polygon, shape
+from shapely.ops import unary_union
+from scipy.spatial import Voronoi, cKDTree
 
 logger = logging.getLogger(__name__)
 
 
+def _voronoi_cells(points, outline):
+    """
+    Unclipped Voronoi cells of two or more `points`, which together cover
+    `outline`.
+    """
+
+    xmin, ymin = np.minimum(np.amin(points, axis=0), outline.bounds[:2])
+    xmax, ymax = np.maximum(np.amax(points, axis=0), outline.bounds[2:])
+    span = np.hypot(xmax - xmin, ymax - ymin)
+
+    # to avoid any network positions outside all Voronoi cells, append
+    # the corners of a rectangle framing these points and the outline;
+    # a distance of one diagonal guarantees that the cells of the corners
+    # do not reach into the outline
+    vor = Voronoi(np.vstack((points,
+                             [[xmin-span, ymin-span],
+                              [xmin-span, ymax+span],
+                              [xmax+span, ymin-span],
+                              [xmax+span, ymax+span]])))
+
+    polygons = gpd.GeoSeries([Polygon(vor.vertices[vor.regions[vor.point_region[i]]])
+                              for i in range(len(points))], dtype='geometry')
+
+    invalid_b = ~polygons.is_valid
+    polygons[invalid_b] = polygons[invalid_b].buffer(0)
+
+    return polygons
+
+
 def voronoi_partition_pts(points, outline):
     """
     Compute the polygons of a voronoi partition of `points` within the
@@ -74,34 +111,122 @@ def voronoi_partition_pts(points, outline):
     if len(points) == 1:
         polygons = [outline]
     else:
-        xmin, ymin = np.amin(points, axis=0)
-        xmax, ymax = np.amax(points, axis=0)
-        xspan = xmax - xmin
-        yspan = ymax - ymin
+        polygons = _voronoi_cells(points, outline)
+
+        # cells lying entirely inside the outline need no clipping
+        clip_b = ~polygons.within(outline)
+        polygons[clip_b] = polygons[clip_b].intersection(outline)
 
-        # to avoid any network positions outside all Voronoi cells, append
-        # the corners of a rectangle framing these points
-        vor = Voronoi(np.vstack((points,
-                                 [[xmin-3.*xspan, ymin-3.*yspan],
-                                  [xmin-3.*xspan, ymax+3.*yspan],
-                                  [xmax+3.*xspan, ymin-3.*yspan],
-                                  [xmax+3.*xspan, ymax+3.*yspan]])))
+    return np.array(polygons, dtype=object)
 
-        polygons = []
-        for i in range(len(points)):
-            poly = Polygon(vor.vertices[vor.regions[vor.point_region[i]]])
 
-            if not poly.is_valid:
-                poly = poly.buffer(0)
+def voronoi_partition_pts_raster(points, outline, res=0.05):
+    """
+    Approximate the polygons of a voronoi partition of `points` within the
+    polygon `outline` by labelling each cell of a raster with resolution
+    `res` with its nearest point and polygonising the labels again. Avoids
+    intersecting every Voronoi cell with a potentially complex outline.
 
-            poly = poly.intersection(outline)
+    Each point keeps the raster cell it lies in. Points left without any
+    raster cell, e.g. several points within one raster cell, get their exact
+    Voronoi cell, which is cut out of the neighbouring regions. All regions
+    are clipped to `outline`.
 
-            polygons.append(poly)
+    Attributes
+    ----------
+    points : Nx2 - ndarray[dtype=float]
+    outline : Polygon
+    res : float
+    Returns
+    -------
+    polygons : N - ndarray[dtype=Polygon|MultiPolygon]
+    """
 
+    points = np.asarray(points)
+
+    if len(points) == 1:
+        return np.array([outline], dtype=object)
+
+    xmin, ymin, xmax, ymax = outline.bounds
+    width = max(int(np.ceil((xmax - xmin) / res)), 1)
+    height = max(int(np.ceil((ymax - ymin) / res)), 1)
+    transform = rio.Affine(res, 0, xmin, 0, -res, ymax)
+
+    # all cells touching the outline, such that clipping them covers it fully
+    mask = geometry_mask([outline], (height, width), transform, all_touched=True, invert=True)
+    if not mask.any():
+        # outline too small to be resolved by the raster
+        return voronoi_partition_pts(points, outline)
+
+    rows, cols = np.nonzero(mask)
+    centers = np.column_stack((xmin + (cols + 0.5) * res, ymax - (rows + 0.5) * res))
+    labels = np.zeros((height, width), dtype=np.int32)
+    labels[rows, cols] = cKDTree(points).query(centers)[1]
+
+    # every point keeps the raster cell it lies in
+    point_rows = np.floor((ymax - points[:, 1]) / res).astype(int)
+    point_cols = np.floor((points[:, 0] - xmin) / res).astype(int)
+    in_raster_b = ((point_rows >= 0) & (point_rows < height) &
+                   (point_cols >= 0) & (point_cols < width))
+    in_raster_b[in_raster_b] = mask[point_rows[in_raster_b], point_cols[in_raster_b]]
+    labels[point_rows[in_raster_b], point_cols[in_raster_b]] = np.flatnonzero(in_raster_b)
+
+    parts = [[] for _ in range(len(points))]
+    for geom, label in shapes(labels, mask=mask, transform=transform):
+        parts[int(label)].append(shape(geom))
+
+    polygons = gpd.GeoSeries([unary_union(p) if p else Polygon() for p in parts], dtype='geometry')
+
+    missing_b = polygons.is_empty
+    if missing_b.any():
+        cells = _voronoi_cells(points, outline)[missing_b]
+        cut = unary_union(list(cells))
+        cut_b = ~missing_b & polygons.intersects(cut)
+        polygons[cut_b] = polygons[cut_b].difference(cut)
+        polygons[missing_b] = cells
+
+    # raster cells along the border reach beyond the outline
+    clip_b = ~polygons.within(outline)
+    polygons[clip_b] = polygons[clip_b].intersection(outline)
 
     return np.array(polygons, dtype=object)
 
 
+def build_country_regions(buses, onshore_shape, offshore_shape=None,
+                          partition=voronoi_partition_pts):
+    """
+    Compute the onshore and offshore Voronoi regions of the buses of a single
+    country. Kept at module level such that it can be dispatched to a
+    process pool.
+
+    `partition` is the function used to divide the shapes among the buses,
+    either :func:`voronoi_partition_pts` or :func:`voronoi_partition_pts_raster`.
+
+    Returns
+    -------
+    onshore_regions, offshore_regions : dict, dict or None
+        Region geometries by bus name.
+    """
+
+    onshore_locs = buses.loc[buses.substation_lv, ["x", "y"]]
+    onshore_regions = dict(zip(onshore_locs.index,
+                               partition(onshore_locs.values, onshore_shape)))
+
+    if offshore_shape is None: return onshore_regions, None
+
+    offshore_locs = buses.loc[buses.substation_off, ["x", "y"]]
+    offshore_regions = dict(zip(offshore_locs.index,
+                                partition(offshore_locs.values, offshore_shape)))
+
+    return onshore_regions, offshore_regions
+
+
+def regions_to_geodataframe(regions, buses):
+    return gpd.GeoDataFrame(buses.loc[list(regions), ['x', 'y', 'country']],
+                            geometry=list(regions.values()), crs=4326
+                           ).rename_axis('name').reset_index()
+
+
 if __name__ == "__main__":
     if 'snakemake' not in globals():
         from _helpers import mock_snakemake
@@ -110,43 +235,42 @@ if __name__ == "__main__":
 
     countries = snakemake.config['countries']
 
-    n = pypsa.Network(snakemake.input.base_network)
-
     country_shapes = gpd.read_file(snakemake.input.country_shapes).set_index('name')['geometry']
     offshore_shapes = gpd.read_file(snakemake.input.offshore_shapes)
     offshore_shapes = offshore_shapes.reindex(columns=REGION_COLS).set_index('name')['geometry']
 
-    onshore_regions = []
-    offshore_regions = []
-
-    for country in countries:
-        c_b = n.buses.country == country
-
-        onshore_shape = country_shapes[country]
-        onshore_locs = n.buses.loc[c_b & n.buses.substation_lv, ["x", "y"]]
-        onshore_regions.append(gpd.GeoDataFrame({
-                'name': onshore_locs.index,
-                'x': onshore_locs['x'],
-                'y': onshore_locs['y'],
-                'geometry': voronoi_partition_pts(onshore_locs.values, onshore_shape),
-                'country': country
-            }))
-
-        if country not in offshore_shapes.index: continue
-        offshore_shape = offshore_shapes[country]
-        offshore_locs = n.buses.loc[c_b & n.buses.substation_off, ["x", "y"]]
-        offshore_regions_c = gpd.GeoDataFrame({
-                'name': offshore_locs.index,
-                'x': offshore_locs['x'],
-                'y': offshore_locs['y'],
-                'geometry': voronoi_partition_pts(offshore_locs.values, offshore_shape),
-                'country': country
-            })
-        offshore_regions_c = offshore_regions_c.loc[offshore_regions_c.area > 1e-2]
-        offshore_regions.append(offshore_regions_c)
-
-    pd.concat(onshore_regions, ignore_index=True).to_file(snakemake.output.regions_onshore)
-    if offshore_regions:
-        pd.concat(offshore_regions, ignore_index=True).to_file(snakemake.output.regions_offshore)
+    buses = pd.read_csv(snakemake.input.buses, index_col='name', dtype={'name': str})
+    country_i = buses.groupby('country').indices
+    tasks = [(buses.iloc[country_i.get(country, [])],
+              country_shapes[country], offshore_shapes.get(country))
+             for country in countries]
+
+    config = snakemake.config.get('bus_regions', {})
+    if config.get('method', 'voronoi') == 'raster':
+        partition = partial(voronoi_partition_pts_raster,
+                            res=config.get('raster_resolution', 0.05))
+    else:
+        partition = voronoi_partition_pts
+
+    build = partial(build_country_regions, partition=partition)
+    nprocesses = int(snakemake.threads)
+    if nprocesses > 1:
+        with mp.Pool(processes=nprocesses) as pool:
+            regions = pool.starmap(build, tasks)
+    else:
+        regions = [build(*task) for task in tasks]
+
+    onshore_regions = {}
+    offshore_regions = {}
+    for onshore_regions_c, offshore_regions_c in regions:
+        onshore_regions.update(onshore_regions_c)
+        if offshore_regions_c is not None:
+            offshore_regions.update(offshore_regions_c)
+
+    regions_to_geodataframe(onshore_regions, buses).to_file(snakemake.output.regions_onshore)
+    if any(c in offshore_shapes.index for c in countries):
+        offshore_regions = regions_to_geodataframe(offshore_regions, buses)
+        offshore_regions = offshore_regions.loc[offshore_regions.area > 1e-2]
+        offshore_regions.to_file(snakemake.output.regions_offshore)
     else:
-        offshore_shapes.to_frame().to_file(snakemake.output.regions_offshore)
\ No newline at end of file
+        offshore_shapes.to_frame().to_file(snakemake.output.regions_offshore)
@@ -64,6 +64,7 @@ from _helpers import configure_logging
 
 import atlite
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 
 import country_converter as coco
@@ -73,7 +74,9 @@ cc = coco.CountryConverter()
 def get_eia_annual_hydro_generation(fn, countries):
 
     # in billion kWh/a = TWh/a
-    df = pd.read_csv(fn, skiprows=2, index_col=1, na_values=[u' ','--']).iloc[1:, 1:]
+    # skip the preamble and the units row and do not parse the API codes
+    df = pd.read_csv(fn, skiprows=[0, 1, 3], index_col=0, na_values=[u' ','--'],
+                     usecols=lambda c: c != 'API')
     df.index = df.index.str.strip()
 
     former_countries = {
@@ -89,18 +92,18 @@ def get_eia_annual_hydro_generation(fn, countries):
     }
 
     for k, v in former_countries.items():
-        period = [str(i) for i in range(v["start"], v["end"]+1)]
-        ratio = df.loc[v['countries']].T.dropna().sum()
+        period = np.arange(v["start"], v["end"]+1).astype(str)
+        ratio = df.loc[v['countries']].dropna(axis=1).sum(axis=1)
         ratio /= ratio.sum()
-        for country in v['countries']:
-            df.loc[country, period] = df.loc[k, period] * ratio[country]
+        df.loc[v['countries'], period] = np.outer(ratio[v['countries']], df.loc[k, period])
 
     baltic_states = ["Latvia", "Estonia", "Lithuania"]
-    df.loc[baltic_states] = df.loc[baltic_states].T.fillna(df.loc[baltic_states].mean(axis=1)).T
+    baltic = df.loc[baltic_states]
+    df.loc[baltic_states] = baltic.where(baltic.notna(), baltic.mean(axis=1), axis=0)
 
     df.loc["Germany"] = df.filter(like='Germany', axis=0).sum()
     df.loc["Serbia"] += df.loc["Kosovo"].fillna(0.)
-    df = df.loc[~df.index.str.contains('Former')]
+    df = df.drop(index=list(former_countries))
     df.drop(["Europe", "Germany, West", "Germany, East", "Kosovo"], inplace=True)
 
     df.index = cc.convert(df.index, to='iso2')
@@ -138,4 +141,6 @@ if __name__ == "__main__":
     if 'clip_min_inflow' in config_hydro:
         inflow = inflow.where(inflow > config_hydro['clip_min_inflow'], 0)
 
-    inflow.to_netcdf(snakemake.output[0])
+    inflow = inflow.astype('float32').rename('inflow')
+    encoding = {'inflow': {'zlib': True, 'complevel': 4}}
+    inflow.to_netcdf(snakemake.output[0], encoding=encoding)
@@ -44,9 +44,14 @@ from _helpers import configure_logging
 
 import atlite
 import geopandas as gpd
+import numpy as np
 import rasterio as rio
+import multiprocessing as mp
+from functools import partial
 from rasterio.features import geometry_mask
 from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+from shapely.geometry import box
 
 logger = logging.getLogger(__name__)
 
@@ -67,6 +72,31 @@ def get_transform_and_shape(bounds, res):
     return transform, shape
 
 
+def get_windows(shape, size):
+    height, width = shape
+    for row_off in range(0, height, size):
+        for col_off in range(0, width, size):
+            yield Window(col_off, row_off, min(size, width - col_off),
+                         min(size, height - row_off))
+
+
+def get_window_geometries(geometries, shape, transform, size=4096):
+    """Yield the raster windows together with the geometries overlapping them."""
+    for window in get_windows(shape, size):
+        bounds = rio.windows.bounds(window, transform)
+        yield window, geometries.iloc[geometries.sindex.query(box(*bounds))]
+
+
+def rasterize_window(task, transform):
+    window, geometries = task
+    shape = (int(window.height), int(window.width))
+    if len(geometries) == 0:
+        return window, np.zeros(shape, dtype=rio.uint8)
+    window_transform = rio.windows.transform(window, transform)
+    raster = ~geometry_mask(geometries, shape, window_transform)
+    return window, raster.astype(rio.uint8)
+
+
 if __name__ == "__main__":
     if 'snakemake' not in globals():
         from _helpers import mock_snakemake
@@ -78,12 +108,25 @@ if __name__ == "__main__":
     bounds = transform_bounds(4326, 3035, min(xs), min(ys), max(Xs), max(Ys))
     transform, out_shape = get_transform_and_shape(bounds, res=100)
 
-    # adjusted boundaries
-    shapes = gpd.read_file(snakemake.input.natura).to_crs(3035)
-    raster = ~geometry_mask(shapes.geometry, out_shape[::-1], transform)
-    raster = raster.astype(rio.uint8)
+    # adjusted boundaries; only read shapes overlapping the cutouts
+    extent = gpd.GeoSeries([box(*bounds)], crs=3035)
+    shapes = gpd.read_file(snakemake.input.natura, bbox=extent).to_crs(3035)
+    raster_shape = out_shape[::-1]
 
+    # rasterise tiles in parallel, each only with the shapes overlapping it,
+    # and write them as they come in such that the full raster is never held
+    # in memory
+    tasks = get_window_geometries(shapes.geometry, raster_shape, transform)
+    nprocesses = int(snakemake.threads)
     with rio.open(snakemake.output[0], 'w', driver='GTiff', dtype=rio.uint8,
                   count=1, transform=transform, crs=3035, compress='lzw',
-                  width=raster.shape[1], height=raster.shape[0]) as dst:
-        dst.write(raster, indexes=1)
+                  width=raster_shape[1], height=raster_shape[0], tiled=True,
+                  blockxsize=512, blockysize=512, BIGTIFF='IF_SAFER') as dst:
+        func = partial(rasterize_window, transform=transform)
+        if nprocesses > 1:
+            with mp.Pool(processes=nprocesses) as pool:
+                for window, tile in pool.imap_unordered(func, tasks):
+                    dst.write(tile, indexes=1, window=window)
+        else:
+            for window, tile in map(func, tasks):
+                dst.write(tile, indexes=1, window=window)
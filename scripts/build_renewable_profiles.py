@@ -61,8 +61,8 @@ Inputs
 
 - ``resources/natura.tiff``: confer :ref:`natura`
 - ``resources/offshore_shapes.geojson``: confer :ref:`shapes`
-- ``resources/regions_onshore.geojson``: (if not offshore wind), confer :ref:`busregions`
-- ``resources/regions_offshore.geojson``: (if offshore wind), :ref:`busregions`
+- ``resources/regions_onshore.gpkg``: (if not offshore wind), confer :ref:`busregions`
+- ``resources/regions_offshore.gpkg``: (if offshore wind), :ref:`busregions`
 - ``"cutouts/" + config["renewable"][{technology}]['cutout']``: :ref:`cutout`
 - ``networks/base.nc``: :ref:`base`
 
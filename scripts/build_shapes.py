@@ -71,28 +71,21 @@ import logging
 from _helpers import configure_logging
 
 import numpy as np
+import multiprocessing as mp
 from operator import attrgetter
-from functools import reduce
 from itertools import takewhile
 
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import MultiPolygon, Polygon
 from shapely.ops import unary_union
+from shapely.validation import make_valid
 import pycountry as pyc
 
 logger = logging.getLogger(__name__)
 
 
-def _get_country(target, **keys):
-    assert len(keys) == 1
-    try:
-        return getattr(pyc.countries.get(**keys), target)
-    except (KeyError, AttributeError):
-        return np.nan
-
-
-def _simplify_polys(polys, minarea=0.1, tolerance=0.01, filterremote=True):
+def _filter_polys(polys, minarea=0.1, filterremote=True):
     if isinstance(polys, MultiPolygon):
         polys = sorted(polys.geoms, key=attrgetter('area'), reverse=True)
         mainpoly = polys[0]
@@ -103,63 +96,91 @@ def _simplify_polys(polys, minarea=0.1, tolerance=0.01, filterremote=True):
                                   if not filterremote or (mainpoly.distance(p) < mainlength)])
         else:
             polys = mainpoly
-    return polys.simplify(tolerance=tolerance)
+    return polys
+
+
+def _make_valid_polygonal(poly):
+    # make_valid keeps every lobe of a self-intersecting ring, but may also
+    # return lines or points along the former self-intersections
+    poly = make_valid(poly)
+    if isinstance(poly, (Polygon, MultiPolygon)):
+        return poly
+    return unary_union([p for p in getattr(poly, 'geoms', [])
+                        if isinstance(p, (Polygon, MultiPolygon))])
+
+
+def _simplify_polys(polys, minarea=0.1, tolerance=0.01, filterremote=True, preserve_topology=True):
+    # drop small and remote parts shape by shape, but simplify all at once
+    polys = polys.map(lambda p: _filter_polys(p, minarea=minarea, filterremote=filterremote))
+    polys = polys.simplify(tolerance=tolerance, preserve_topology=preserve_topology)
+    if not preserve_topology:
+        # plain Douglas-Peucker may leave self-intersections behind
+        invalid = ~polys.is_valid
+        polys.loc[invalid] = polys.loc[invalid].map(_make_valid_polygonal)
+    return polys
 
 
 def countries(naturalearth, country_list):
     if 'RS' in country_list: country_list.append('KV')
 
-    df = gpd.read_file(naturalearth)
+    df = gpd.read_file(naturalearth, engine='pyogrio', where='scalerank IN (0, 5)',
+                       columns=['ISO_A2', 'WB_A2', 'ADM0_A3', 'scalerank'])
 
     # Names are a hassle in naturalearth, try several fields
-    fieldnames = (df[x].where(lambda s: s!='-99') for x in ('ISO_A2', 'WB_A2', 'ADM0_A3'))
-    df['name'] = reduce(lambda x,y: x.fillna(y), fieldnames, next(fieldnames)).str[0:2]
+    fields = [df[x].to_numpy() for x in ('ISO_A2', 'WB_A2', 'ADM0_A3')]
+    names = np.select([pd.notna(f) & (f != '-99') for f in fields], fields, default=np.nan)
+    df['name'] = pd.Series(names, index=df.index).str[0:2]
 
-    df = df.loc[df.name.isin(country_list) & ((df['scalerank'] == 0) | (df['scalerank'] == 5))]
-    s = df.set_index('name')['geometry'].map(_simplify_polys)
+    df = df.loc[df.name.isin(country_list)]
+    s = _simplify_polys(df.set_index('name')['geometry'])
     if 'RS' in country_list: s['RS'] = s['RS'].union(s.pop('KV'))
 
     return s
 
 
 def eez(country_shapes, eez, country_list):
+    alpha3 = {c.alpha_2: c.alpha_3 for c in pyc.countries}
+    alpha2 = {v: k for k, v in alpha3.items()}
+
     df = gpd.read_file(eez)
-    df = df.loc[df['ISO_3digit'].isin([_get_country('alpha_3', alpha_2=c) for c in country_list])]
-    df['name'] = df['ISO_3digit'].map(lambda c: _get_country('alpha_2', alpha_3=c))
-    s = df.set_index('name').geometry.map(lambda s: _simplify_polys(s, filterremote=False))
-    s = gpd.GeoSeries({k:v for k,v in s.iteritems() if v.distance(country_shapes[k]) < 1e-3})
+    df = df.loc[df['ISO_3digit'].isin([alpha3.get(c) for c in country_list])]
+    df['name'] = df['ISO_3digit'].map(alpha2)
+    s = _simplify_polys(df.set_index('name').geometry, filterremote=False)
+    s = s.loc[s.distance(country_shapes.reindex(s.index), align=False) < 1e-3]
+    s = s.loc[~s.index.duplicated(keep='last')]
     s = s.to_frame("geometry")
     s.index.name = "name"
     return s
 
 
 def country_cover(country_shapes, eez_shapes=None):
-    shapes = country_shapes
+    shapes = list(country_shapes)
     if eez_shapes is not None:
-        shapes = pd.concat([shapes, eez_shapes])
+        shapes += list(eez_shapes)
 
     europe_shape = unary_union(shapes)
     if isinstance(europe_shape, MultiPolygon):
-        europe_shape = max(europe_shape, key=attrgetter('area'))
+        europe_shape = max(europe_shape.geoms, key=attrgetter('area'))
     return Polygon(shell=europe_shape.exterior)
 
 
 def nuts3(country_shapes, nuts3, nuts3pop, nuts3gdp, ch_cantons, ch_popgdp):
-    df = gpd.read_file(nuts3)
-    df = df.loc[df['STAT_LEVL_'] == 3]
-    df['geometry'] = df['geometry'].map(_simplify_polys)
+    df = gpd.read_file(nuts3, engine='pyogrio', where='STAT_LEVL_ = 3', columns=['NUTS_ID'])
+    df['geometry'] = _simplify_polys(df['geometry'], preserve_topology=False)
     df = df.rename(columns={'NUTS_ID': 'id'})[['id', 'geometry']].set_index('id')
 
-    pop = pd.read_table(nuts3pop, na_values=[':'], delimiter=' ?\t', engine='python')
+    pop = pd.read_table(nuts3pop, na_values=[':', ': '])
+    pop.columns = pop.columns.str.strip()
     pop = (pop
-           .set_index(pd.MultiIndex.from_tuples(pop.pop('unit,geo\\time').str.split(','))).loc['THS']
-           .applymap(lambda x: pd.to_numeric(x, errors='coerce'))
+           .set_index(pd.MultiIndex.from_frame(pop.pop('unit,geo\\time').str.split(',', expand=True))).loc['THS']
+           .apply(pd.to_numeric, errors='coerce')
            .fillna(method='bfill', axis=1))['2014']
 
-    gdp = pd.read_table(nuts3gdp, na_values=[':'], delimiter=' ?\t', engine='python')
+    gdp = pd.read_table(nuts3gdp, na_values=[':', ': '])
+    gdp.columns = gdp.columns.str.strip()
     gdp = (gdp
-           .set_index(pd.MultiIndex.from_tuples(gdp.pop('unit,geo\\time').str.split(','))).loc['EUR_HAB']
-           .applymap(lambda x: pd.to_numeric(x, errors='coerce'))
+           .set_index(pd.MultiIndex.from_frame(gdp.pop('unit,geo\\time').str.split(',', expand=True))).loc['EUR_HAB']
+           .apply(pd.to_numeric, errors='coerce')
            .fillna(method='bfill', axis=1))['2014']
 
     cantons = pd.read_csv(ch_cantons)
@@ -170,13 +191,15 @@ def nuts3(country_shapes, nuts3, nuts3pop, nuts3gdp, ch_cantons, ch_popgdp):
     swiss.columns = swiss.columns.to_series().map(cantons)
 
     swiss_pop = pd.to_numeric(swiss.loc['Residents in 1000', 'CH040':])
-    pop = pd.concat([pop, swiss_pop])
+    pop = pd.Series(np.concatenate([pop.to_numpy(), swiss_pop.to_numpy()]), index=pop.index.append(swiss_pop.index))
     swiss_gdp = pd.to_numeric(swiss.loc['Gross domestic product per capita in Swiss francs', 'CH040':])
-    gdp = pd.concat([gdp, swiss_gdp])
+    gdp = pd.Series(np.concatenate([gdp.to_numpy(), swiss_gdp.to_numpy()]), index=gdp.index.append(swiss_gdp.index))
 
     df = df.join(pd.DataFrame(dict(pop=pop, gdp=gdp)))
 
-    df['country'] = df.index.to_series().str[:2].replace(dict(UK='GB', EL='GR'))
+    prefix = df.index.str[:2]
+    iso2 = dict(UK='GB', EL='GR')
+    df['country'] = prefix.map(iso2).where(prefix.isin(list(iso2)), prefix)
 
     excludenuts = pd.Index(('FRA10', 'FRA20', 'FRA30', 'FRA40', 'FRA50',
                             'PT200', 'PT300',
@@ -184,17 +207,16 @@ def nuts3(country_shapes, nuts3, nuts3pop, nuts3gdp, ch_cantons, ch_popgdp):
                             'FI2', 'FR9'))
     excludecountry = pd.Index(('MT', 'TR', 'LI', 'IS', 'CY', 'KV'))
 
-    df = df.loc[df.index.difference(excludenuts)]
-    df = df.loc[~df.country.isin(excludecountry)]
+    df = df.loc[~df.index.isin(excludenuts) & ~df.country.isin(excludecountry)]
 
+    manual = [row for row in [['BA1', 'BA', 3871.],
+                              ['RS1', 'RS', 7210.],
+                              ['AL1', 'AL', 2893.]]
+              if row[1] in country_shapes.index]
     manual = gpd.GeoDataFrame(
-        [['BA1', 'BA', 3871.],
-         ['RS1', 'RS', 7210.],
-         ['AL1', 'AL', 2893.]],
-        columns=['NUTS_ID', 'country', 'pop']
+        [row + [country_shapes[row[1]]] for row in manual],
+        columns=['NUTS_ID', 'country', 'pop', 'geometry']
     ).set_index('NUTS_ID')
-    manual['geometry'] = manual['country'].map(country_shapes)
-    manual = manual.dropna()
 
     df = pd.concat([df, manual], sort=False)
 
@@ -210,14 +232,26 @@ if __name__ == "__main__":
     configure_logging(snakemake)
 
     country_shapes = countries(snakemake.input.naturalearth, snakemake.config['countries'])
-    country_shapes.reset_index().to_file(snakemake.output.country_shapes)
-
-    offshore_shapes = eez(country_shapes, snakemake.input.eez, snakemake.config['countries'])
-    offshore_shapes.reset_index().to_file(snakemake.output.offshore_shapes)
+    country_shapes.reset_index().to_file(snakemake.output.country_shapes, driver='GeoJSON', engine='pyogrio')
+
+    # eez and nuts3 only depend on the country shapes, build them side by side
+    eez_args = (country_shapes, snakemake.input.eez, snakemake.config['countries'])
+    nuts3_args = (country_shapes, snakemake.input.nuts3, snakemake.input.nuts3pop,
+                  snakemake.input.nuts3gdp, snakemake.input.ch_cantons, snakemake.input.ch_popgdp)
+    nprocesses = int(snakemake.threads)
+    if nprocesses > 1:
+        with mp.Pool(processes=2) as pool:
+            offshore_shapes = pool.apply_async(eez, eez_args)
+            nuts3_shapes = pool.apply_async(nuts3, nuts3_args)
+            offshore_shapes = offshore_shapes.get()
+            nuts3_shapes = nuts3_shapes.get()
+    else:
+        offshore_shapes = eez(*eez_args)
+        nuts3_shapes = nuts3(*nuts3_args)
+
+    offshore_shapes.reset_index().to_file(snakemake.output.offshore_shapes, driver='GeoJSON', engine='pyogrio')
 
     europe_shape = gpd.GeoDataFrame(geometry=[country_cover(country_shapes, offshore_shapes.geometry)])
-    europe_shape.reset_index().to_file(snakemake.output.europe_shape)
+    europe_shape.reset_index().to_file(snakemake.output.europe_shape, driver='GeoJSON', engine='pyogrio')
 
-    nuts3_shapes = nuts3(country_shapes, snakemake.input.nuts3, snakemake.input.nuts3pop,
-                         snakemake.input.nuts3gdp, snakemake.input.ch_cantons, snakemake.input.ch_popgdp)
-    nuts3_shapes.reset_index().to_file(snakemake.output.nuts3_shapes)
+    nuts3_shapes.reset_index().to_file(snakemake.output.nuts3_shapes, driver='GeoJSON', engine='pyogrio')
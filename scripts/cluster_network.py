@@ -13,6 +13,7 @@ Relevant Settings
 
     clustering:
       cluster_network:
+      distribute_clusters:
       aggregation_strategies:
 
     focus_weights:
@@ -125,6 +126,7 @@ import logging
 from _helpers import configure_logging, update_p_nom_max, get_aggregation_strategies
 
 import pypsa
+import multiprocessing as mp
 
 import pandas as pd
 import numpy as np
@@ -133,10 +135,10 @@ import pyomo.environ as po
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-from functools import reduce
+from scipy.sparse import coo_matrix
 
-from pypsa.networkclustering import (busmap_by_kmeans, busmap_by_hac,
-                                     busmap_by_greedy_modularity, get_clustering_from_busmap)
+from pypsa.networkclustering import (busmap_by_kmeans, busmap_by_greedy_modularity,
+                                     get_clustering_from_busmap)
 
 import warnings
 warnings.filterwarnings(action='ignore', category=UserWarning)
@@ -151,17 +153,29 @@ logger = logging.getLogger(__name__)
 def normed(x): return (x/x.sum()).fillna(0.)
 
 
-def weighting_for_country(n, x):
+def conventional_capacity_per_bus(n):
     conv_carriers = {'OCGT','CCGT','PHS', 'hydro'}
-    gen = (n
-           .generators.loc[n.generators.carrier.isin(conv_carriers)]
-           .groupby('bus').p_nom.sum()
-           .reindex(n.buses.index, fill_value=0.) +
-           n
-           .storage_units.loc[n.storage_units.carrier.isin(conv_carriers)]
-           .groupby('bus').p_nom.sum()
-           .reindex(n.buses.index, fill_value=0.))
-    load = n.loads_t.p_set.mean().groupby(n.loads.bus).sum()
+    capacity = np.zeros(len(n.buses))
+    for df in (n.generators, n.storage_units):
+        df = df.loc[df.carrier.isin(conv_carriers)]
+        bus_i = n.buses.index.get_indexer(df.bus)
+        capacity += np.bincount(bus_i[bus_i >= 0], weights=df.p_nom.values[bus_i >= 0],
+                                minlength=len(n.buses))
+    return pd.Series(capacity, index=n.buses.index)
+
+
+def mean_load_per_bus(n):
+    p_set = n.loads_t.p_set
+    mean = pd.Series(p_set.to_numpy().mean(axis=0), index=p_set.columns)
+    return mean.groupby(n.loads.bus).sum()
+
+
+def weighting_for_country(n, x, gen=None, load=None):
+    # pass in `gen` and `load` when weighting many countries of the same network
+    if gen is None:
+        gen = conventional_capacity_per_bus(n)
+    if load is None:
+        load = mean_load_per_bus(n)
 
     b_i = x.index
     g = normed(gen.reindex(b_i, fill_value=0))
@@ -182,23 +196,25 @@ def get_feature_for_hac(n, buses_i=None, feature=None):
     carriers = feature.split('-')[0].split('+')
     if "offwind" in carriers:
         carriers.remove("offwind")
-        carriers = np.append(carriers, network.generators.carrier.filter(like='offwind').unique())
+        carriers = np.append(carriers, n.generators.carrier.filter(like='offwind').unique())
+
+    gen_groups = n.generators.groupby('carrier').groups
+    gen_groups = {carrier: gen_groups.get(carrier, pd.Index([])) for carrier in carriers}
+    bus_of_gen = n.generators.bus
 
     if feature.split('-')[1] == 'cap':
-        feature_data = pd.DataFrame(index=buses_i, columns=carriers)
-        for carrier in carriers:
-            gen_i = n.generators.query("carrier == @carrier").index
-            attach = n.generators_t.p_max_pu[gen_i].mean().rename(index = n.generators.loc[gen_i].bus)
-            feature_data[carrier] = attach
+        # average the profiles of all carriers in one pass
+        gen_i = np.concatenate(list(gen_groups.values()))
+        feature_data = (n.generators_t.p_max_pu[gen_i].mean()
+                        .groupby([n.generators.carrier[gen_i].values, bus_of_gen[gen_i].values]).sum()
+                        .unstack(0)
+                        .reindex(index=buses_i, columns=carriers))
 
     if feature.split('-')[1] == 'time':
-        feature_data = pd.DataFrame(columns=buses_i)
-        for carrier in carriers:
-            gen_i = n.generators.query("carrier == @carrier").index
-            attach = n.generators_t.p_max_pu[gen_i].rename(columns = n.generators.loc[gen_i].bus)
-            feature_data = pd.concat([feature_data, attach], axis=0)[buses_i]
+        feature_data = pd.concat([n.generators_t.p_max_pu[gen_i].rename(columns=bus_of_gen)
+                                  for gen_i in gen_groups.values()], axis=0)
 
-        feature_data = feature_data.T
+        feature_data = feature_data.reindex(columns=buses_i).T
         # timestamp raises error in sklearn >= v1.2:
         feature_data.columns = feature_data.columns.astype(str)
 
@@ -207,11 +223,41 @@ def get_feature_for_hac(n, buses_i=None, feature=None):
     return feature_data
 
 
-def distribute_clusters(n, n_clusters, focus_weights=None, solver_name="cbc"):
+def distribute_clusters_greedy(L, N, n_clusters):
+    """
+    Round the ideal number of clusters ``L * n_clusters`` per country to
+    integers between 1 and ``N`` that add up to ``n_clusters``.
+
+    Clusters are added (or removed) one at a time where they increase the
+    squared deviation from the ideal number the least. Since the objective is
+    separable and convex, this solves the same problem as the quadratic
+    program in :func:`distribute_clusters` exactly.
+    """
+
+    ideal = L.values * n_clusters
+    upper = N.reindex(L.index).values
+
+    n = np.clip(np.floor(ideal), 1, upper)
+    if n.sum() > n_clusters:
+        n = np.clip(np.ceil(ideal), 1, upper)
+
+    while n.sum() < n_clusters:
+        n[np.argmin(np.where(n < upper, 2 * (n - ideal) + 1, np.inf))] += 1
+    while n.sum() > n_clusters:
+        n[np.argmin(np.where(n > 1, 2 * (ideal - n) + 1, np.inf))] -= 1
+
+    assert ((n >= 1) & (n <= upper)).all(), "Could not distribute clusters within the bounds."
+
+    return pd.Series(n, index=L.index).astype(int)
+
+
+def distribute_clusters(n, n_clusters, focus_weights=None, solver_name="cbc", load=None, method="greedy"):
     """Determine the number of clusters per country"""
 
-    L = (n.loads_t.p_set.mean()
-         .groupby(n.loads.bus).sum()
+    if load is None:
+        load = mean_load_per_bus(n)
+
+    L = (load
          .groupby([n.buses.country, n.buses.sub_network]).sum()
          .pipe(normed))
 
@@ -226,16 +272,22 @@ def distribute_clusters(n, n_clusters, focus_weights=None, solver_name="cbc"):
 
         assert total_focus <= 1.0, "The sum of focus weights must be less than or equal to 1."
 
-        for country, weight in focus_weights.items():
-            L[country] = weight / len(L[country])
+        # spread each focus weight evenly over the sub networks of its country
+        country = pd.Series(L.index.get_level_values('country'), index=L.index)
+        focus = country.isin(list(focus_weights))
+        L[focus] = country[focus].map(focus_weights) / country[focus].map(country[focus].value_counts())
 
-        remainder = [c not in focus_weights.keys() for c in L.index.get_level_values('country')]
-        L[remainder] = L.loc[remainder].pipe(normed) * (1 - total_focus)
+        L[~focus] = L[~focus].pipe(normed) * (1 - total_focus)
 
         logger.warning('Using custom focus weights for determining number of clusters.')
 
     assert np.isclose(L.sum(), 1.0, rtol=1e-3), f"Country weights L must sum up to 1.0 when distributing clusters. Is {L.sum()}."
 
+    if method == "greedy":
+        return distribute_clusters_greedy(L, N, n_clusters)
+    elif method != "solver":
+        raise ValueError(f"`method` must be one of 'greedy' or 'solver'. Is {method}.")
+
     m = po.ConcreteModel()
     def n_bounds(model, *n_id):
         return (1, N[n_id])
@@ -255,32 +307,95 @@ def distribute_clusters(n, n_clusters, focus_weights=None, solver_name="cbc"):
     return pd.Series(m.n.get_values(), index=L.index).round().astype(int)
 
 
-def busmap_for_n_clusters(n, n_clusters, solver_name, focus_weights=None, algorithm="kmeans", feature=None, **algorithm_kwds):
+def bus_adjacency_matrix(n):
+    """Sparse adjacency matrix of all buses over all branch components."""
+    bus_idx = pd.Series(np.arange(len(n.buses)), index=n.buses.index)
+    branches = n.branches()
+    rows = bus_idx[branches.bus0].values
+    cols = bus_idx[branches.bus1].values
+    return coo_matrix((np.ones(len(rows)), (rows, cols)),
+                      shape=(len(bus_idx), len(bus_idx))).tocsr()
+
+
+def busmap_by_hac(n_clusters, buses_i, feature, connectivity):
+    """
+    Ward clustering of ``feature`` restricted to neighbouring buses.
+
+    Same as ``pypsa.networkclustering.busmap_by_hac`` but takes the
+    connectivity of ``buses_i`` as sparse matrix, instead of slicing it from a
+    dense adjacency matrix of the whole network.
+    """
+    from sklearn.cluster import AgglomerativeClustering as HAC
+
+    labels = HAC(n_clusters=n_clusters, connectivity=connectivity, linkage='ward').fit_predict(feature)
+
+    return pd.Series(labels, index=buses_i, dtype=str)
+
+
+def busmap_for_country(n, buses_i, prefix, n_clusters, algorithm, weight=None, feature=None,
+                       connectivity=None, algorithm_kwds=None):
+    algorithm_kwds = algorithm_kwds or {}
+    logger.debug(f"Determining busmap for country {prefix[:-1]}")
+    if len(buses_i) == 1:
+        return pd.Series(prefix + '0', index=buses_i)
+
+    if algorithm == "kmeans":
+        return prefix + busmap_by_kmeans(n, weight, n_clusters, buses_i=buses_i, **algorithm_kwds)
+    elif algorithm == "hac":
+        return prefix + busmap_by_hac(n_clusters, buses_i, feature, connectivity)
+    elif algorithm == "modularity":
+        return prefix + busmap_by_greedy_modularity(n, n_clusters, buses_i=buses_i)
+    else:
+        raise ValueError(f"`algorithm` must be one of 'kmeans' or 'hac'. Is {algorithm}.")
+
+
+_shared_network = None
+
+
+def _set_shared_network(n):
+    global _shared_network
+    _shared_network = n
+    # the pool already runs one worker per thread, so sklearn's OpenMP/BLAS
+    # threads would oversubscribe the cores
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=1)
+
+
+def _busmap_for_country_on_shared_network(*args):
+    return busmap_for_country(_shared_network, *args)
+
+
+def busmap_for_n_clusters(n, n_clusters, solver_name, focus_weights=None, algorithm="kmeans", feature=None,
+                          distribution_method="greedy", nprocesses=1, **algorithm_kwds):
     if algorithm == "kmeans":
         algorithm_kwds.setdefault('n_init', 1000)
         algorithm_kwds.setdefault('max_iter', 30000)
         algorithm_kwds.setdefault('tol', 1e-6)
         algorithm_kwds.setdefault('random_state', 0)
 
-    def fix_country_assignment_for_hac(n):
+    def fix_country_assignment_for_hac(n, adjacency):
         from scipy.sparse import csgraph
 
+        # position of the first line attached to each bus
+        first_line = (pd.Series(np.tile(np.arange(len(n.lines)), 2),
+                                index=np.concatenate([n.lines.bus0.values, n.lines.bus1.values]))
+                      .groupby(level=0).min())
+
+        country_idx = n.buses.groupby('country').indices
+
         # overwrite country of nodes that are disconnected from their country-topology
         for country in n.buses.country.unique():
-            m = n[n.buses.country ==country].copy()
+            idx = country_idx[country]
 
-            _, labels = csgraph.connected_components(m.adjacency_matrix(), directed=False)
+            _, labels = csgraph.connected_components(adjacency[idx][:, idx], directed=False)
 
-            component = pd.Series(labels, index=m.buses.index)
+            component = pd.Series(labels, index=n.buses.index[idx])
             component_sizes = component.value_counts()
 
             if len(component_sizes)>1:
                 disconnected_bus = component[component==component_sizes.index[-1]].index[0]
 
-                neighbor_bus = (
-                    n.lines.query("bus0 == @disconnected_bus or bus1 == @disconnected_bus")
-                    .iloc[0][['bus0', 'bus1']]
-                )
+                neighbor_bus = n.lines.iloc[first_line[disconnected_bus]][['bus0', 'bus1']]
                 new_country = list(set(n.buses.loc[neighbor_bus].country)-set([country]))[0]
 
                 logger.info(
@@ -289,11 +404,18 @@ def busmap_for_n_clusters(n, n_clusters, solver_name, focus_weights=None, algori
                     "from its inital inter-country transmission grid."
                 )
                 n.buses.at[disconnected_bus, "country"] = new_country
+
+                # keep the bus positions per country in sync for the remaining countries
+                pos = n.buses.index.get_loc(disconnected_bus)
+                country_idx[country] = idx[idx != pos]
+                country_idx[new_country] = np.sort(np.append(country_idx[new_country], pos))
         return n
 
     if algorithm == "hac":
         feature = get_feature_for_hac(n, buses_i=n.buses.index, feature=feature)
-        n = fix_country_assignment_for_hac(n)
+        # one adjacency matrix, sliced for the country subgraphs
+        adjacency = bus_adjacency_matrix(n)
+        n = fix_country_assignment_for_hac(n, adjacency)
 
     if (algorithm != "hac") and (feature is not None):
         logger.warning(f"Keyword argument feature is only valid for algorithm `hac`. "
@@ -301,36 +423,48 @@ def busmap_for_n_clusters(n, n_clusters, solver_name, focus_weights=None, algori
 
     n.determine_network_topology()
 
-    n_clusters = distribute_clusters(n, n_clusters, focus_weights=focus_weights, solver_name=solver_name)
+    # both only depend on buses, not on countries, and are shared by all country groups
+    load = mean_load_per_bus(n)
+    gen = conventional_capacity_per_bus(n)
 
-    def busmap_for_country(x):
-        prefix = x.name[0] + x.name[1] + ' '
-        logger.debug(f"Determining busmap for country {prefix[:-1]}")
-        if len(x) == 1:
-            return pd.Series(prefix + '0', index=x.index)
-        weight = weighting_for_country(n, x)
+    n_clusters = distribute_clusters(n, n_clusters, focus_weights=focus_weights,
+                                     solver_name=solver_name, load=load, method=distribution_method)
 
+    tasks = []
+    for name, buses_i in n.buses.groupby(['country', 'sub_network']).groups.items():
+        weight = features = connectivity = None
         if algorithm == "kmeans":
-            return prefix + busmap_by_kmeans(n, weight, n_clusters[x.name], buses_i=x.index, **algorithm_kwds)
+            weight = weighting_for_country(n, buses_i.to_series(), gen=gen, load=load)
         elif algorithm == "hac":
-            return prefix + busmap_by_hac(n, n_clusters[x.name], buses_i=x.index, feature=feature.loc[x.index])
-        elif algorithm == "modularity":
-            return prefix + busmap_by_greedy_modularity(n, n_clusters[x.name], buses_i=x.index)
-        else:
-            raise ValueError(f"`algorithm` must be one of 'kmeans' or 'hac'. Is {algorithm}.")
+            idx = n.buses.index.get_indexer(buses_i)
+            features = feature.loc[buses_i]
+            connectivity = adjacency[idx][:, idx]
+        tasks.append((buses_i, name[0] + name[1] + ' ', n_clusters[name], algorithm,
+                      weight, features, connectivity, algorithm_kwds))
+
+    if nprocesses > 1 and algorithm != "modularity":
+        # kmeans only reads the bus coordinates and hac none of the network, so
+        # the workers get a network of bare buses instead of a copy of n
+        buses = pypsa.Network()
+        buses.madd("Bus", n.buses.index, x=n.buses.x, y=n.buses.y)
+        with mp.Pool(processes=nprocesses, initializer=_set_shared_network, initargs=(buses,)) as pool:
+            busmaps = pool.starmap(_busmap_for_country_on_shared_network, tasks)
+    else:
+        busmaps = [busmap_for_country(n, *task) for task in tasks]
 
-    return (n.buses.groupby(['country', 'sub_network'], group_keys=False)
-            .apply(busmap_for_country).squeeze().rename('busmap'))
+    return pd.concat(busmaps).rename('busmap')
 
 
 def clustering_for_n_clusters(n, n_clusters, custom_busmap=False, aggregate_carriers=None,
                               line_length_factor=1.25, aggregation_strategies=dict(), solver_name="cbc",
-                              algorithm="hac", feature=None, extended_link_costs=0, focus_weights=None):
+                              algorithm="hac", feature=None, extended_link_costs=0, focus_weights=None,
+                              distribution_method="greedy", nprocesses=1):
 
     bus_strategies, generator_strategies = get_aggregation_strategies(aggregation_strategies)
 
     if not isinstance(custom_busmap, pd.Series):
-        busmap = busmap_for_n_clusters(n, n_clusters, solver_name, focus_weights, algorithm, feature)
+        busmap = busmap_for_n_clusters(n, n_clusters, solver_name, focus_weights, algorithm, feature,
+                                       distribution_method=distribution_method, nprocesses=nprocesses)
     else:
         busmap = custom_busmap
 
@@ -356,17 +490,24 @@ def clustering_for_n_clusters(n, n_clusters, custom_busmap=False, aggregate_carr
     return clustering
 
 
+def compose_busmaps(busmaps):
+    busmap = busmaps[0]
+    for b in busmaps[1:]:
+        busmap = pd.Series(b.reindex(busmap.values).values, index=busmap.index, name=busmap.name)
+    return busmap
+
+
 def cluster_regions(busmaps, input=None, output=None):
 
-    busmap = reduce(lambda x, y: x.map(y), busmaps[1:], busmaps[0])
+    busmap = compose_busmaps(busmaps)
 
     for which in ('regions_onshore', 'regions_offshore'):
-        regions = gpd.read_file(getattr(input, which))
+        regions = gpd.read_file(getattr(input, which), engine='pyogrio', columns=['name'])
         regions = regions.reindex(columns=["name", "geometry"]).set_index('name')
         regions_c = regions.dissolve(busmap)
         regions_c.index.name = 'name'
         regions_c = regions_c.reset_index()
-        regions_c.to_file(getattr(output, which))
+        regions_c.to_file(getattr(output, which), engine='pyogrio')
 
 
 def plot_busmap_for_n_clusters(n, n_clusters, fn=None):
@@ -440,7 +581,9 @@ if __name__ == "__main__":
                                                snakemake.config['solving']['solver']['name'],
                                                cluster_config.get("algorithm", "hac"),
                                                cluster_config.get("feature", "solar+onwind-time"),
-                                               hvac_overhead_cost, focus_weights)
+                                               hvac_overhead_cost, focus_weights,
+                                               snakemake.config.get('clustering', {}).get('distribute_clusters', 'greedy'),
+                                               int(snakemake.threads))
 
     update_p_nom_max(clustering.network)
 
@@ -47,8 +47,8 @@ Inputs
 ------
 
 - ``resources/costs.csv``: The database of cost assumptions for all included technologies for specific years from various sources; e.g. discount rate, lifetime, investment (CAPEX), fixed operation and maintenance (FOM), variable operation and maintenance (VOM), fuel costs, efficiency, carbon-dioxide intensity.
-- ``resources/regions_onshore.geojson``: confer :ref:`busregions`
-- ``resources/regions_offshore.geojson``: confer :ref:`busregions`
+- ``resources/regions_onshore.gpkg``: confer :ref:`busregions`
+- ``resources/regions_offshore.gpkg``: confer :ref:`busregions`
 - ``networks/elec.nc``: confer :ref:`electricity`
 
 Outputs
@@ -85,17 +85,17 @@ The rule :mod:`simplify_network` does up to four things:
 """
 
 import logging
+from itertools import chain
 from _helpers import configure_logging, update_p_nom_max, get_aggregation_strategies
 
-from cluster_network import clustering_for_n_clusters, cluster_regions
+from cluster_network import clustering_for_n_clusters, cluster_regions, compose_busmaps
 from add_electricity import load_costs
 
 import pandas as pd
 import numpy as np
 import scipy as sp
 from scipy.sparse.csgraph import connected_components, dijkstra
-
-from functools import reduce
+from scipy.spatial.distance import cdist
 
 import pypsa
 from pypsa.io import import_components_from_dataframe, import_series_from_dataframe
@@ -115,25 +115,28 @@ def simplify_network_to_380(n):
     n.lines.loc[lines_v_nom_b, 'num_parallel'] *= (n.lines.loc[lines_v_nom_b, 'v_nom'] / 380.)**2
     n.lines.loc[lines_v_nom_b, 'v_nom'] = 380.
     n.lines.loc[lines_v_nom_b, 'type'] = linetype_380
-    n.lines.loc[lines_v_nom_b, 's_nom'] = (
-        np.sqrt(3) * n.lines['type'].map(n.line_types.i_nom) *
-        n.lines.bus0.map(n.buses.v_nom) * n.lines.num_parallel
-    )
-
-    # Replace transformers by lines
-    trafo_map = pd.Series(n.transformers.bus1.values, index=n.transformers.bus0.values)
-    trafo_map = trafo_map[~trafo_map.index.duplicated(keep='first')]
-    several_trafo_b = trafo_map.isin(trafo_map.index)
-    trafo_map.loc[several_trafo_b] = trafo_map.loc[several_trafo_b].map(trafo_map)
-    missing_buses_i = n.buses.index.difference(trafo_map.index)
-    missing = pd.Series(missing_buses_i, missing_buses_i)
-    trafo_map = pd.concat([trafo_map, missing])
-
+    # all remapped lines now share the 380 kV line type and bus voltage
+    s_nom_per_circuit = np.sqrt(3) * n.line_types.at[linetype_380, 'i_nom'] * 380.
+    n.lines.loc[lines_v_nom_b, 's_nom'] = s_nom_per_circuit * n.lines.loc[lines_v_nom_b, 'num_parallel'].values
+
+    # Replace transformers by lines: every bus0 is mapped onto the bus1 of its
+    # first transformer, following chains of transformers to their last bus
+    buses_i = n.buses.index
+    first_trafo_b = ~n.transformers.bus0.duplicated(keep='first')
+    next_bus = np.arange(len(buses_i))
+    next_bus[buses_i.get_indexer(n.transformers.bus0[first_trafo_b])] = buses_i.get_indexer(n.transformers.bus1[first_trafo_b])
+    # pointer jumping doubles the followed chain length in every step
+    for _ in range(int(np.log2(max(len(buses_i), 1))) + 1):
+        next_next_bus = next_bus[next_bus]
+        if (next_next_bus == next_bus).all(): break
+        next_bus = next_next_bus
+    trafo_map = pd.Series(buses_i[next_bus], index=buses_i)
+
+    trafo_dict = trafo_map.to_dict()
     for c in n.one_port_components|n.branch_components:
         df = n.df(c)
-        for col in df.columns:
-            if col.startswith('bus'):
-                df[col] = df[col].map(trafo_map)
+        for col in df.columns[df.columns.str.startswith('bus')]:
+            df[col] = df[col].map(trafo_dict)
 
     n.mremove("Transformer", n.transformers.index)
     n.mremove("Bus", n.buses.index.difference(trafo_map))
@@ -165,30 +168,51 @@ def _compute_connection_costs_to_bus(n, busmap, costs, config, connection_costs_
         buses = busmap.index[busmap.index != busmap.values]
 
     connection_costs_to_bus = pd.DataFrame(index=buses)
+    if not connection_costs_per_link:
+        return connection_costs_to_bus
+
+    # the graph is the same for all techs, only the link weights change
+    bus0 = n.buses.index.get_indexer(pd.concat([n.links.bus0, n.lines.bus0]))
+    bus1 = n.buses.index.get_indexer(pd.concat([n.links.bus1, n.lines.bus1]))
+    line_weights = np.zeros(len(n.lines))
+    src = n.buses.index.get_indexer(buses)
+    dst = n.buses.index.get_indexer(busmap.loc[buses].values)
+    src_i = np.arange(len(buses))
 
     for tech in connection_costs_per_link:
-        adj = n.adjacency_matrix(weights=pd.concat(dict(Link=connection_costs_per_link[tech].reindex(n.links.index),
-                                                        Line=pd.Series(0., n.lines.index))))
+        weights = np.concatenate([connection_costs_per_link[tech].reindex(n.links.index).values, line_weights])
+        adj = sp.sparse.coo_matrix((weights, (bus0, bus1)), shape=(len(n.buses), len(n.buses)))
 
-        costs_between_buses = dijkstra(adj, directed=False, indices=n.buses.index.get_indexer(buses))
-        connection_costs_to_bus[tech] = costs_between_buses[np.arange(len(buses)),
-                                                            n.buses.index.get_indexer(busmap.loc[buses])]
+        costs_between_buses = dijkstra(adj, directed=False, indices=src)
+        connection_costs_to_bus[tech] = costs_between_buses[src_i, dst]
 
     return connection_costs_to_bus
 
 
 def _adjust_capital_costs_using_connection_costs(n, connection_costs_to_bus, output):
+    if connection_costs_to_bus.empty:
+        # no offshore techs or no displaced buses
+        pd.DataFrame().to_csv(output.connection_costs)
+        return
+
     connection_costs = {}
+    gens_by_carrier = n.generators.groupby('carrier', sort=False).indices
+    gen_bus = n.generators.bus.values
+    capital_cost = n.generators.capital_cost.values.copy()
     for tech in connection_costs_to_bus:
-        tech_b = n.generators.carrier == tech
-        costs = n.generators.loc[tech_b, "bus"].map(connection_costs_to_bus[tech]).loc[lambda s: s>0]
-        if not costs.empty:
-            n.generators.loc[costs.index, "capital_cost"] += costs
+        if tech not in gens_by_carrier: continue
+        idx = gens_by_carrier[tech]
+        costs = connection_costs_to_bus[tech].reindex(gen_bus[idx]).values
+        displaced_b = costs > 0
+        if displaced_b.any():
+            idx, costs = idx[displaced_b], costs[displaced_b]
+            capital_cost[idx] += costs
+            costs = pd.Series(costs, index=n.generators.index[idx])
             logger.info("Displacing {} generator(s) and adding connection costs to capital_costs: {} "
-                        .format(tech, ", ".join("{:.0f} Eur/MW/a for `{}`".format(d, b) for b, d in costs.iteritems())))
+                        .format(tech, ", ".join("{:.0f} Eur/MW/a for `{}`".format(d, b) for b, d in costs.items())))
             connection_costs[tech] = costs
-    pd.DataFrame(connection_costs).to_csv(output.connection_costs) 
-            
+    n.generators['capital_cost'] = capital_cost
+    pd.DataFrame(connection_costs).to_csv(output.connection_costs)
 
 
 def _aggregate_and_move_components(n, busmap, connection_costs_to_bus, output,
@@ -238,35 +262,53 @@ def simplify_links(n, costs, config, output, aggregation_strategies=dict()):
     _, labels = connected_components(adjacency_matrix, directed=False)
     labels = pd.Series(labels, n.buses.index)
 
-    G = n.graph()
+    # CSR adjacency of all branches; the neighbours of a bus are ordered by
+    # their first branch, like the adjacency of the networkx graph
+    branches = n.branches()
+    bus0 = n.buses.index.get_indexer(branches.bus0)
+    bus1 = n.buses.index.get_indexer(branches.bus1)
+    branch_b = np.r_[np.ones(len(branches), dtype=bool), bus0 != bus1]
+    row = np.r_[bus0, bus1][branch_b]
+    col = np.r_[bus1, bus0][branch_b]
+    branch = np.r_[np.arange(len(branches)), np.arange(len(branches))][branch_b]
+    order = np.lexsort((branch, row))
+    col, branch = col[order].tolist(), branch[order].tolist()
+    indptr = np.r_[0, np.bincount(row, minlength=len(n.buses)).cumsum()].tolist()
+
+    def neighbours(m):
+        adj = {}
+        for m2, i in zip(col[indptr[m]:indptr[m+1]], branch[indptr[m]:indptr[m+1]]):
+            adj.setdefault(m2, []).append(branches.index[i])
+        return adj
 
     def split_links(nodes):
-        nodes = frozenset(nodes)
+        nodes = frozenset(n.buses.index.get_indexer(nodes).tolist())
+        adj = {m: neighbours(m) for m in nodes}
 
         seen = set()
         supernodes = {m for m in nodes
-                      if len(G.adj[m]) > 2 or (set(G.adj[m]) - nodes)}
+                      if len(adj[m]) > 2 or (set(adj[m]) - nodes)}
 
         for u in supernodes:
-            for m, ls in G.adj[u].items():
+            for m, ls in adj[u].items():
                 if m not in nodes or m in seen: continue
 
                 buses = [u, m]
-                links = [list(ls)] #[name for name in ls]]
+                links = [ls]
 
                 while m not in (supernodes | seen):
                     seen.add(m)
-                    for m2, ls in G.adj[m].items():
+                    for m2, ls in adj[m].items():
                         if m2 in seen or m2 == u: continue
                         buses.append(m2)
-                        links.append(list(ls)) # [name for name in ls])
+                        links.append(ls)
                         break
                     else:
                         # stub
                         break
                     m = m2
                 if m != u:
-                    yield pd.Index((u, m)), buses, links
+                    yield n.buses.index[[u, m]], list(n.buses.index[buses]), links
             seen.add(u)
 
     busmap = n.buses.index.to_series()
@@ -274,6 +316,13 @@ def simplify_links(n, costs, config, output, aggregation_strategies=dict()):
     connection_costs_per_link = _prepare_connection_costs_per_link(n, costs, config)
     connection_costs_to_bus = pd.DataFrame(0., index=n.buses.index, columns=list(connection_costs_per_link))
 
+    # joined links are swapped in after all components have been walked
+    static_attrs = n.components["Link"]["attrs"].loc[lambda df: df.static]
+    new_links = {}
+    removed_links = []
+    joined_buses = []
+    xy = n.buses[['x', 'y']].values
+
     for lbl in labels.value_counts().loc[lambda s: s > 2].index:
 
         for b, buses, links in split_links(labels.index[labels == lbl]):
@@ -282,22 +331,24 @@ def simplify_links(n, costs, config, output, aggregation_strategies=dict()):
             logger.debug('nodes = {}'.format(labels.index[labels == lbl]))
             logger.debug('b = {}\nbuses = {}\nlinks = {}'.format(b, buses, links))
 
-            m = sp.spatial.distance_matrix(n.buses.loc[b, ['x', 'y']],
-                                           n.buses.loc[buses[1:-1], ['x', 'y']])
+            m = cdist(xy[n.buses.index.get_indexer(b)], xy[n.buses.index.get_indexer(buses[1:-1])])
             busmap.loc[buses] = b[np.r_[0, m.argmin(axis=0), 1]]
-            connection_costs_to_bus.loc[buses] += _compute_connection_costs_to_bus(n, busmap, costs, config, connection_costs_per_link, buses)
+            joined_buses.extend(buses)
 
-            all_links = [i for _, i in sum(links, [])]
+            all_links = [i for _, i in chain.from_iterable(links)]
+            # parallel links between two consecutive buses form one segment
+            segment = np.repeat(np.arange(len(links)), [len(l) for l in links])
+            corridor = n.links.loc[all_links, ['length', 'p_nom', 'underwater_fraction']]
 
             p_max_pu = config['links'].get('p_max_pu', 1.)
-            lengths = n.links.loc[all_links, 'length']
+            lengths = corridor.length
             name = lengths.idxmax() + '+{}'.format(len(links) - 1)
             params = dict(
                 carrier='DC',
                 bus0=b[0], bus1=b[1],
-                length=sum(n.links.loc[[i for _, i in l], 'length'].mean() for l in links),
-                p_nom=min(n.links.loc[[i for _, i in l], 'p_nom'].sum() for l in links),
-                underwater_fraction=sum(lengths/lengths.sum() * n.links.loc[all_links, 'underwater_fraction']),
+                length=lengths.groupby(segment).mean().sum(),
+                p_nom=corridor.p_nom.groupby(segment).sum().min(),
+                underwater_fraction=sum(lengths/lengths.sum() * corridor.underwater_fraction),
                 p_max_pu=p_max_pu,
                 p_min_pu=-p_max_pu,
                 underground=False,
@@ -306,13 +357,19 @@ def simplify_links(n, costs, config, output, aggregation_strategies=dict()):
 
             logger.info("Joining the links {} connecting the buses {} to simple link {}".format(", ".join(all_links), ", ".join(buses), name))
 
-            n.mremove("Link", all_links)
+            removed_links.extend(all_links)
 
-            static_attrs = n.components["Link"]["attrs"].loc[lambda df: df.static]
             for attr, default in static_attrs.default.iteritems(): params.setdefault(attr, default)
-            n.links.loc[name] = pd.Series(params)
+            new_links[name] = params
+
+    if joined_buses and connection_costs_per_link:
+        # one multi-source dijkstra per tech for all corridors at once
+        joined_buses = pd.Index(joined_buses).unique()
+        connection_costs_to_bus.loc[joined_buses] += _compute_connection_costs_to_bus(n, busmap, costs, config, connection_costs_per_link, joined_buses)
 
-            # n.add("Link", **params)
+    if new_links:
+        n.mremove("Link", removed_links)
+        n.links = pd.concat([n.links, pd.DataFrame.from_dict(new_links, orient='index')]).rename_axis(n.links.index.name)
 
     logger.debug("Collecting all components using the busmap")
 
@@ -383,7 +440,8 @@ def cluster(n, n_clusters, config, algorithm="hac", feature=None, aggregation_st
                                            aggregation_strategies=aggregation_strategies,
                                            solver_name=config['solving']['solver']['name'],
                                            algorithm=algorithm, feature=feature,
-                                           focus_weights=focus_weights)
+                                           focus_weights=focus_weights,
+                                           distribution_method=config.get('clustering', {}).get('distribute_clusters', 'greedy'))
 
     return clustering.network, clustering.busmap
 
@@ -430,7 +488,8 @@ if __name__ == "__main__":
     ):
         carriers = cluster_config.get("feature", "solar+onwind-time").split('-')[0].split('+')
         for carrier in carriers:
-            buses_i = list(set(n.buses.index)-set(n.generators.query("carrier == @carrier").bus))
+            # n is re-clustered for every carrier, so the generators are looked up anew
+            buses_i = n.buses.index.difference(n.generators.bus.values[n.generators.carrier.values == carrier])
             logger.info(f'clustering preparaton (hac): aggregating {len(buses_i)} buses of type {carrier}.')
             n, busmap_hac = aggregate_to_substations(n, aggregation_strategies, buses_i)
             busmaps.append(busmap_hac)
@@ -452,7 +511,7 @@ if __name__ == "__main__":
     n.meta = dict(snakemake.config, **dict(wildcards=dict(snakemake.wildcards)))
     n.export_to_netcdf(snakemake.output.network)
 
-    busmap_s = reduce(lambda x, y: x.map(y), busmaps[1:], busmaps[0])
+    busmap_s = compose_busmaps(busmaps)
     busmap_s.to_csv(snakemake.output.busmap)
 
-    cluster_regions(busmaps, snakemake.input, snakemake.output)
+    cluster_regions((busmap_s,), snakemake.input, snakemake.output)